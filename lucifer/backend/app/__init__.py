@@ -1,2 +1,2 @@
 """backend.app package init."""
-__all__ = ["main", "services", "models"]
+__all__ = ["main", "services", "models", "scheduler"]
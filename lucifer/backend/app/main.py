@@ -1,14 +1,22 @@
 import asyncio
+import functools
+import hashlib
+import hmac
 import logging
+import mmap
 import os
-from typing import Optional
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import JSONResponse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, Tuple, Union
+
+import anyio
+from cachetools import LRUCache
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse
 from dotenv import load_dotenv
 
 from .services import HuggingService
 from .models import ChatRequest
+from .scheduler import InferenceScheduler, RequestCoalescer
 
 logger = logging.getLogger("backend.app")
 
@@ -16,187 +24,182 @@ logger = logging.getLogger("backend.app")
 load_dotenv()
 HF_TOKEN = os.getenv("HF_TOKEN")
 API_KEY = os.getenv("API_KEY")
+_API_KEY_BYTES = API_KEY.encode() if API_KEY else None
+
+# Probe endpoints reachable without an API key
+_PUBLIC_PATHS = {"/health", "/ready"}
 
 # Construct service if possible
-service = HuggingService(HF_TOKEN) if HF_TOKEN else None
+DATASET_CACHE_BYTES = int(os.getenv("DATASET_CACHE_BYTES", str(2 << 30)))
+service = HuggingService(HF_TOKEN, dataset_cache_bytes=DATASET_CACHE_BYTES) if HF_TOKEN else None
 
-app = FastAPI(title="HuggingFace Multimodal Assistant Backend")
+app = FastAPI(title="HuggingFace Multimodal Assistant Backend", default_response_class=ORJSONResponse)
 
-# Thread pool for blocking tasks
-IO_POOL = ThreadPoolExecutor(max_workers=4)
+# Admission control in front of HF calls so heavy jobs cannot starve light ones
+scheduler = InferenceScheduler()
 
+# Blocking calls share AnyIO's default thread limiter with FastAPI's own
+# sync-endpoint path; its size is set at startup from BACKEND_THREAD_LIMIT.
+THREAD_LIMIT = int(os.getenv("BACKEND_THREAD_LIMIT", "32"))
 
-async def run_blocking(fn, *args, **kwargs):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(IO_POOL, lambda: fn(*args, **kwargs))
+# CPU-bound work (e.g. image decode/resize) goes to worker processes via run_cpu,
+# kept apart from the I/O threads so neither kind of job starves the other and
+# CPU work is not serialized by the GIL. Workers start on first use.
+CPU_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
 
 
-@app.middleware("http")
-async def api_key_middleware(request: Request, call_next):
-    # Allow health check without key
-    if request.url.path == "/health":
-        return await call_next(request)
+async def run_cpu(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CPU_POOL, functools.partial(fn, *args, **kwargs))
 
-    if not API_KEY:
-        # No API key configured; allow but log
-        logger.warning("API_KEY not configured; endpoints are unprotected")
-        return await call_next(request)
 
-    provided = request.headers.get("x-api-key") or request.headers.get("X-API-KEY")
-    if provided != API_KEY:
-        return JSONResponse(status_code=401, content={"detail": "Unauthorized - invalid API key"})
-    return await call_next(request)
+# Uploads above this size are memory-mapped from disk instead of read into RAM.
+UPLOAD_SPOOL_THRESHOLD = 1 << 20
 
+# Upload routes admitted through a bounded number of slots; extra requests wait
+# up to UPLOAD_ADMIT_TIMEOUT seconds (before their bodies are read) and then 503.
+UPLOAD_PATHS = {"/voice", "/image", "/vqa", "/any-to-any"}
+UPLOAD_SLOTS = asyncio.Semaphore(int(os.getenv("MAX_PENDING_UPLOADS", "32")))
+UPLOAD_ADMIT_TIMEOUT = float(os.getenv("UPLOAD_ADMIT_TIMEOUT", "5"))
+# Upload requests declaring a larger Content-Length are refused with 413
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 << 20)))
 
-@app.post("/dataset")
-async def load_any_dataset(name: str = Form(...), subset: Optional[str] = Form(None), streaming: Optional[bool] = Form(False)):
-    if service is None:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
-    try:
-        info = await run_blocking(service.load_dataset, name, subset, streaming)
-        return {"status": "success", "dataset": info}
-    except Exception as e:
-        logger.exception("Dataset load failed")
-        raise HTTPException(status_code=500, detail=str(e))
+# Results of repeat-identical inference requests, keyed per endpoint, plus the
+# in-flight calls for keys not cached yet
+RESULT_CACHE: LRUCache = LRUCache(maxsize=int(os.getenv("RESULT_CACHE_SIZE", "4096")))
+coalescer = RequestCoalescer()
 
 
-@app.post("/chat")
-async def chat_endpoint(body: ChatRequest):
-    if service is None:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
-    try:
-        model = body.model or "gpt2"
-        text = await run_blocking(service.generate_text, body.prompt, model, body.max_new_tokens)
-        return {"status": "success", "model": model, "output": text}
-    except Exception as e:
-        logger.exception("Chat error")
-        raise HTTPException(status_code=500, detail=str(e))
+async def spool(file: UploadFile, threshold: int = UPLOAD_SPOOL_THRESHOLD) -> Union[bytes, memoryview]:
+    """Return an upload's body without buffering large payloads in memory.
 
+    Starlette already spools multipart files into a SpooledTemporaryFile that
+    rolls over to disk past 1 MiB. Small bodies are read as bytes; larger ones
+    are mapped read-only from the spool file and returned as a memoryview, so
+    the inference client sends them from the page cache rather than from a
+    per-request copy.
+    """
+    spooled = file.file
+    spooled.seek(0, os.SEEK_END)
+    size = spooled.tell()
+    spooled.seek(0)
+    if size <= threshold:
+        return await file.read()
+    return memoryview(mmap.mmap(spooled.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+async def run_sync_until_disconnect(request: Request, fn: Callable[[], Any]) -> Any:
+    """Run blocking `fn` in a worker thread, abandoning it if the client goes away.
+
+    Neither uvicorn nor Starlette cancels an endpoint when its client
+    disconnects, so a watcher waits for `http.disconnect` (the request body has
+    already been consumed) and cancels the thread call. That releases the
+    limiter token and the endpoint at once. The thread itself cannot be killed
+    and runs `fn` to completion, so e.g. a dataset load still lands in the cache.
+    Raises HTTPException(499) when the client disconnected.
+    """
+    result: List[Any] = []
+    async with anyio.create_task_group() as task_group:
 
-@app.post("/voice")
-async def voice_to_text(file: UploadFile = File(...)):
-    if service is None:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
-    try:
-        audio = await file.read()
-        text = await run_blocking(service.transcribe_audio, audio)
-        return {"status": "success", "text": text}
-    except Exception as e:
-        logger.exception("Voice error")
-        raise HTTPException(status_code=500, detail=str(e))
+        async def watch_disconnect() -> None:
+            while (await request.receive())["type"] != "http.disconnect":
+                pass
+            task_group.cancel_scope.cancel()
 
+        task_group.start_soon(watch_disconnect)
+        result.append(await anyio.to_thread.run_sync(fn, cancellable=True))
+        task_group.cancel_scope.cancel()
+    if not result:
+        logger.info("Client disconnected from %s; abandoned worker-thread call", request.url.path)
+        raise HTTPException(status_code=499, detail="Client closed request")
+    return result[0]
 
-@app.post("/image")
-async def image_to_text(file: UploadFile = File(...), model: Optional[str] = Form(None)):
-    if service is None:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
-    try:
-        content = await file.read()
-        model_name = model or "Salesforce/blip-image-captioning-large"
-        caption = await run_blocking(service.analyze_image, content, model_name)
-        return {"status": "success", "model": model_name, "caption": caption}
-    except Exception as e:
-        logger.exception("Image error")
-        raise HTTPException(status_code=500, detail=str(e))
 
+def _blake2b_digest(data: Union[bytes, memoryview]) -> bytes:
+    return hashlib.blake2b(data).digest()
 
-@app.post("/vqa")
-async def vqa_endpoint(file: UploadFile = File(...), question: str = Form(...), model: Optional[str] = Form(None)):
-    if service is None:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
-    try:
-        image_bytes = await file.read()
-        model_name = model or "dandelin/vilt-b32-finetuned-vqa"
-        ans = await run_blocking(service.multimodal_vqa, image_bytes, question, model_name)
-        return {"status": "success", "model": model_name, "answer": ans}
-    except Exception as e:
-        logger.exception("VQA error")
-        raise HTTPException(status_code=500, detail=str(e))
 
+async def upload_digest(data: Union[bytes, memoryview]) -> bytes:
+    """Content digest for result-cache keys.
 
-@app.post("/any-to-any")
-async def any_to_any_endpoint(input_type: str = Form(...), output_type: str = Form(...), model: Optional[str] = Form(None), file: UploadFile = File(None), text: Optional[str] = Form(None), question: Optional[str] = Form(None)):
-    if service is None:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
-    try:
-        payload = None
-        if file:
-            payload = await file.read()
-            if input_type == "image" and output_type == "vqa":
-                payload = {"image": payload, "question": question}
-        elif text is not None:
-            payload = text
-        else:
-            raise HTTPException(status_code=400, detail="No valid payload provided")
+    hashlib releases the GIL while hashing, so spooled (mmapped) uploads are
+    hashed in a worker thread instead of stalling the event loop.
+    """
+    if len(data) > UPLOAD_SPOOL_THRESHOLD:
+        return await anyio.to_thread.run_sync(_blake2b_digest, data)
+    return _blake2b_digest(data)
 
-        result = await run_blocking(service.any_to_any, input_type=input_type, output_type=output_type, payload=payload, model=model)
-        return {"status": "success", "result": result}
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.exception("any-to-any error")
-        raise HTTPException(status_code=500, detail=str(e))
 
+async def cached(key: Hashable, factory: Callable[[], Awaitable[Any]], no_cache: bool = False) -> Tuple[Any, str]:
+    """Return (result, "HIT"|"MISS"), computing and storing misses in RESULT_CACHE.
 
-@app.get("/health")
-async def health():
-    return {"status": "ok"}
+    Concurrent misses for the same key share one call to `factory`. This
+    happens before scheduler admission, so duplicates neither hold scheduler
+    slots nor repeat the round-trip. `no_cache` bypasses the lookup, the
+    sharing and the store.
+    """
+    if no_cache:
+        return await factory(), "MISS"
+    result = RESULT_CACHE.get(key)
+    if result is not None:
+        return result, "HIT"
+    return await coalescer.run(key, functools.partial(_compute_and_store, key, factory)), "MISS"
 
 
-@app.on_event("startup")
-async def on_startup():
-    logger.info("Starting backend app. Supported dataset templates: %s", service.supported if service else {})
+async def _compute_and_store(key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+    result = await factory()
+    RESULT_CACHE[key] = result
+    return result
 
 
-@app.get("/ready")
-async def ready():
-    """Readiness probe: returns 200 when the service has been constructed
-    and can accept lightweight requests. This does not perform heavy model calls.
-    """
-    ok = service is not None
-    if not ok:
-        raise HTTPException(status_code=503, detail="service not ready: HF_TOKEN missing")
-    return {"status": "ready"}
-import asyncio
-import logging
-from typing import Optional
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
-from concurrent.futures import ThreadPoolExecutor
-import os
-
-from .services import HuggingService
-from .models import ChatRequest, DatasetRequest, VQARequest, AnyToAnyRequest
-
-logger = logging.getLogger("backend.app")
+@app.middleware("http")
+async def upload_backpressure_middleware(request: Request, call_next):
+    # Registered before the API-key check, so it runs inside it
+    if request.url.path not in UPLOAD_PATHS:
+        return await call_next(request)
 
-# Read HF token from env
-HF_TOKEN = os.getenv("HF_TOKEN")
-if not HF_TOKEN:
-    logger.error("HF_TOKEN not set. Please set HF_TOKEN in environment or .env file.")
-    # do not raise here to allow import in tests, but endpoints will fail clearly
+    # Checked here rather than in a route dependency: FastAPI parses the
+    # multipart body before dependencies run.
+    if int(request.headers.get("content-length", "0")) > MAX_UPLOAD_BYTES:
+        return JSONResponse(status_code=413, content={"detail": f"Upload exceeds {MAX_UPLOAD_BYTES} bytes"})
 
-# Create service (will raise inside if token missing at call time)
-service = HuggingService(HF_TOKEN) if HF_TOKEN else None
+    try:
+        await asyncio.wait_for(UPLOAD_SLOTS.acquire(), timeout=UPLOAD_ADMIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return JSONResponse(status_code=503, content={"detail": "Server busy - too many pending uploads"}, headers={"Retry-After": "1"})
+    try:
+        return await call_next(request)
+    finally:
+        UPLOAD_SLOTS.release()
 
-app = FastAPI(title="HuggingFace Multimodal Assistant Backend")
 
-# Thread pool for dataset and blocking IO
-IO_POOL = ThreadPoolExecutor(max_workers=4)
+@app.middleware("http")
+async def api_key_middleware(request: Request, call_next):
+    # Allow health/readiness probes without key
+    if request.url.path in _PUBLIC_PATHS:
+        return await call_next(request)
 
+    if _API_KEY_BYTES is None:
+        # No API key configured; allow but log
+        logger.warning("API_KEY not configured; endpoints are unprotected")
+        return await call_next(request)
 
-async def run_blocking(fn, *args, **kwargs):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(IO_POOL, lambda: fn(*args, **kwargs))
+    # Header lookup is case-insensitive; compare in constant time
+    provided = request.headers.get("x-api-key", "")
+    if not hmac.compare_digest(provided.encode(), _API_KEY_BYTES):
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized - invalid API key"})
+    return await call_next(request)
 
 
 @app.post("/dataset")
-async def load_any_dataset(name: str = Form(...), subset: Optional[str] = Form(None), streaming: Optional[bool] = Form(False)):
+async def load_any_dataset(request: Request, name: str = Form(...), subset: Optional[str] = Form(None), streaming: Optional[bool] = Form(False)):
     if service is None:
         raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
     try:
-        info = await run_blocking(service.load_dataset, name, subset, streaming)
+        info = await run_sync_until_disconnect(request, functools.partial(service.load_dataset, name, subset, streaming))
         return {"status": "success", "dataset": info}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Dataset load failed")
         raise HTTPException(status_code=500, detail=str(e))
@@ -208,8 +211,12 @@ async def chat_endpoint(body: ChatRequest):
         raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
     try:
         model = body.model or "gpt2"
-        text = await run_blocking(service.generate_text, body.prompt, model, body.max_new_tokens)
-        return {"status": "success", "model": model, "output": text}
+        text, cache_status = await cached(
+            ("chat", model, body.prompt, body.max_new_tokens),
+            functools.partial(scheduler.submit, "text", len(body.prompt), service.generate_text, body.prompt, model, body.max_new_tokens),
+            no_cache=body.no_cache,
+        )
+        return ORJSONResponse({"status": "success", "model": model, "output": text}, headers={"X-Cache": cache_status})
     except Exception as e:
         logger.exception("Chat error")
         raise HTTPException(status_code=500, detail=str(e))
@@ -220,8 +227,8 @@ async def voice_to_text(file: UploadFile = File(...)):
     if service is None:
         raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
     try:
-        audio = await file.read()
-        text = await run_blocking(service.transcribe_audio, audio)
+        audio = await spool(file)
+        text = await scheduler.submit("audio", len(audio), service.transcribe_audio, audio)
         return {"status": "success", "text": text}
     except Exception as e:
         logger.exception("Voice error")
@@ -229,13 +236,20 @@ async def voice_to_text(file: UploadFile = File(...)):
 
 
 @app.post("/image")
-async def image_to_text(file: UploadFile = File(...), model: Optional[str] = Form(None)):
+async def image_to_text(response: Response, file: UploadFile = File(...), model: Optional[str] = Form(None), no_cache: bool = Form(False)):
     if service is None:
         raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
     try:
-        content = await file.read()
+        content = await spool(file)
         model_name = model or "Salesforce/blip-image-captioning-large"
-        caption = await run_blocking(service.analyze_image, content, model_name)
+        # Only hash the upload when caching is on; the digest keys the cache
+        digest = None if no_cache else await upload_digest(content)
+        caption, cache_status = await cached(
+            ("image", model_name, digest),
+            functools.partial(scheduler.submit, "image", len(content), service.analyze_image, content, model_name),
+            no_cache=no_cache,
+        )
+        response.headers["X-Cache"] = cache_status
         return {"status": "success", "model": model_name, "caption": caption}
     except Exception as e:
         logger.exception("Image error")
@@ -243,13 +257,19 @@ async def image_to_text(file: UploadFile = File(...), model: Optional[str] = For
 
 
 @app.post("/vqa")
-async def vqa_endpoint(file: UploadFile = File(...), question: str = Form(...), model: Optional[str] = Form(None)):
+async def vqa_endpoint(response: Response, file: UploadFile = File(...), question: str = Form(...), model: Optional[str] = Form(None), no_cache: bool = Form(False)):
     if service is None:
         raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
     try:
-        image_bytes = await file.read()
+        image_bytes = await spool(file)
         model_name = model or "dandelin/vilt-b32-finetuned-vqa"
-        ans = await run_blocking(service.multimodal_vqa, image_bytes, question, model_name)
+        digest = None if no_cache else await upload_digest(image_bytes)
+        ans, cache_status = await cached(
+            ("vqa", model_name, question, digest),
+            functools.partial(scheduler.submit, "vqa", len(image_bytes), service.multimodal_vqa, image_bytes, question, model_name),
+            no_cache=no_cache,
+        )
+        response.headers["X-Cache"] = cache_status
         return {"status": "success", "model": model_name, "answer": ans}
     except Exception as e:
         logger.exception("VQA error")
@@ -260,18 +280,23 @@ async def vqa_endpoint(file: UploadFile = File(...), question: str = Form(...),
 async def any_to_any_endpoint(input_type: str = Form(...), output_type: str = Form(...), model: Optional[str] = Form(None), file: UploadFile = File(None), text: Optional[str] = Form(None), question: Optional[str] = Form(None)):
     if service is None:
         raise HTTPException(status_code=500, detail="HF_TOKEN not configured on server")
+    job_class = service.any_to_any_job_class(input_type, output_type)
+    if job_class is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported conversion {input_type}->{output_type}")
     try:
         payload = None
         if file:
-            payload = await file.read()
+            payload = await spool(file)
+            cost = len(payload)
             if input_type == "image" and output_type == "vqa":
                 payload = {"image": payload, "question": question}
         elif text is not None:
             payload = text
+            cost = len(text)
         else:
             raise HTTPException(status_code=400, detail="No valid payload provided")
 
-        result = await run_blocking(service.any_to_any, input_type=input_type, output_type=output_type, payload=payload, model=model)
+        result = await scheduler.submit(job_class, cost, service.any_to_any, input_type=input_type, output_type=output_type, payload=payload, model=model)
         return {"status": "success", "result": result}
     except HTTPException:
         raise
@@ -287,4 +312,23 @@ async def health():
 
 @app.on_event("startup")
 async def on_startup():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_LIMIT
     logger.info("Starting backend app. Supported dataset templates: %s", service.supported if service else {})
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    CPU_POOL.shutdown(wait=False, cancel_futures=True)
+    if service is not None:
+        await service.aclose()
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: returns 200 when the service has been constructed
+    and can accept lightweight requests. This does not perform heavy model calls.
+    """
+    ok = service is not None
+    if not ok:
+        raise HTTPException(status_code=503, detail="service not ready: HF_TOKEN missing")
+    return {"status": "ready"}
@@ -1,11 +1,12 @@
-from typing import Optional
-from pydantic import BaseModel
+from typing import Annotated, Optional
+from pydantic import BaseModel, Field
 
 
 class ChatRequest(BaseModel):
     prompt: str
     model: Optional[str] = None
-    max_new_tokens: Optional[int] = 200
+    max_new_tokens: Annotated[int, Field(gt=0, le=4096)] = 200
+    no_cache: bool = False
 
 
 class DatasetRequest(BaseModel):
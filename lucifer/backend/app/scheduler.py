@@ -0,0 +1,104 @@
+import asyncio
+import heapq
+import itertools
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+# Cheaper job classes are granted first when capacity frees up.
+CLASS_RANK: Dict[str, int] = {"text": 0, "audio": 1, "image": 2, "vqa": 3}
+DEFAULT_LIMITS: Dict[str, int] = {"text": 16, "audio": 4, "image": 4, "vqa": 2}
+
+
+class InferenceScheduler:
+    """Priority admission for inference jobs with per-class concurrency caps.
+
+    Each job class (text < audio < image < vqa) has its own cap, so a burst of
+    heavy VQA calls can never occupy more than its share of slots. Waiting jobs
+    are granted in (class rank, payload size) order, which keeps light requests
+    ahead of large ones once the shared `total` limit is reached.
+    """
+
+    def __init__(self, limits: Dict[str, int] = DEFAULT_LIMITS, total: int = 24):
+        self._limits = dict(limits)
+        self._active = {name: 0 for name in self._limits}
+        self._total = total
+        self._running = 0
+        self._waiters: List[Tuple[int, int, int, str, "asyncio.Future[None]"]] = []
+        self._seq = itertools.count()
+
+    async def submit(self, job_class: str, cost: int, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        if job_class not in self._limits:
+            raise ValueError(f"Unknown job class {job_class}")
+        await self._acquire(job_class, cost)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self._release(job_class)
+
+    def _eligible(self, job_class: str) -> bool:
+        return self._running < self._total and self._active[job_class] < self._limits[job_class]
+
+    async def _acquire(self, job_class: str, cost: int) -> None:
+        if not self._waiters and self._eligible(job_class):
+            self._grant(job_class)
+            return
+        fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (CLASS_RANK.get(job_class, len(CLASS_RANK)), cost, next(self._seq), job_class, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Granted just before the caller went away; hand the slot back.
+                self._release(job_class)
+            raise
+
+    def _grant(self, job_class: str) -> None:
+        self._active[job_class] += 1
+        self._running += 1
+
+    def _release(self, job_class: str) -> None:
+        self._active[job_class] -= 1
+        self._running -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        skipped = []
+        while self._waiters and self._running < self._total:
+            entry = heapq.heappop(self._waiters)
+            job_class, fut = entry[3], entry[4]
+            if fut.done():
+                continue
+            if self._active[job_class] < self._limits[job_class]:
+                self._grant(job_class)
+                fut.set_result(None)
+            else:
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+
+class RequestCoalescer:
+    """Share one in-flight call between concurrent requests with the same key.
+
+    The first caller for a key starts the call; callers arriving before it
+    completes await the same result instead of issuing another round-trip.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(factory())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda done: self._forget(key, done))
+        # Shield so one caller disconnecting does not cancel the shared call.
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: Hashable, fut: "asyncio.Future[Any]") -> None:
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        if not fut.cancelled():
+            # Mark the exception retrieved in case every waiter went away.
+            fut.exception()
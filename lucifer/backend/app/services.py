@@ -1,22 +1,180 @@
+import asyncio
 import logging
-from typing import Optional, Dict, Any
-from huggingface_hub import InferenceClient
+import threading
+import time
+import warnings
+from typing import Optional, Dict, Any, AsyncIterable, Awaitable, Callable, List, Tuple, Union
+import aiohttp
+from cachetools import LRUCache
+from huggingface_hub import AsyncInferenceClient
+from huggingface_hub.inference._common import (
+    TASKS_EXPECTING_IMAGES,
+    ContentT,
+    InferenceTimeoutError,
+    _async_yield_from,
+    _open_as_binary,
+)
 from datasets import load_dataset, Dataset
 
 logger = logging.getLogger(__name__)
 
 
+class PooledAsyncInferenceClient(AsyncInferenceClient):
+    """AsyncInferenceClient whose requests share one keep-alive connector.
+
+    The pinned huggingface_hub builds a new aiohttp ClientSession (and with it a
+    new connector) inside every `post()` call. This override mirrors that
+    method but hands each session the same non-owned TCPConnector, so TLS
+    connections to the inference hosts are kept alive across calls. The only
+    other differences are that the 503 retry sleep is awaited and the session
+    is closed on every error. Every task
+    method (`text_generation`, `image_to_text`, ...) goes through `post()`.
+
+    Written against huggingface_hub 0.19.4: re-check this override and the
+    private `huggingface_hub.inference._common` imports on any version bump.
+    """
+
+    def __init__(self, *args, limit: int = 64, limit_per_host: int = 32, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._connector: Optional[aiohttp.TCPConnector] = None
+
+    def _shared_connector(self) -> aiohttp.TCPConnector:
+        # Created lazily so the connector binds to the running event loop.
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host)
+        return self._connector
+
+    async def post(
+        self,
+        *,
+        json: Optional[Union[str, Dict, List]] = None,
+        data: Optional[ContentT] = None,
+        model: Optional[str] = None,
+        task: Optional[str] = None,
+        stream: bool = False,
+    ) -> Union[bytes, AsyncIterable[bytes]]:
+        url = self._resolve_url(model, task)
+
+        if data is not None and json is not None:
+            warnings.warn("Ignoring `json` as `data` is passed as binary.")
+
+        headers = self.headers.copy()
+        if task in TASKS_EXPECTING_IMAGES and "Accept" not in headers:
+            headers["Accept"] = "image/png"
+
+        t0 = time.time()
+        timeout = self.timeout
+        while True:
+            with _open_as_binary(data) as data_as_binary:
+                # Closing the session leaves the shared connector (and its pooled
+                # connections) open because the session does not own it.
+                client = aiohttp.ClientSession(
+                    headers=headers,
+                    cookies=self.cookies,
+                    timeout=aiohttp.ClientTimeout(self.timeout),
+                    connector=self._shared_connector(),
+                    connector_owner=False,
+                )
+                response_error_payload = None
+                try:
+                    response = await client.post(url, json=json, data=data_as_binary)
+                    if response.status != 200:
+                        try:
+                            response_error_payload = await response.json()
+                        except Exception:
+                            pass
+                    response.raise_for_status()
+                    if stream:
+                        return _async_yield_from(client, response)
+                    content = await response.read()
+                    await client.close()
+                    return content
+                except asyncio.TimeoutError as error:
+                    await client.close()
+                    raise InferenceTimeoutError(f"Inference call timed out: {url}") from error
+                except aiohttp.ClientResponseError as error:
+                    error.response_error_payload = response_error_payload
+                    await client.close()
+                    if error.status == 422 and task is not None:
+                        error.message += f". Make sure '{task}' task is supported by the model."
+                    if error.status != 503:
+                        raise
+                    # Model still loading: retry until the client timeout elapses
+                    if timeout is not None and time.time() - t0 > timeout:
+                        raise InferenceTimeoutError(
+                            f"Model not loaded on the server: {url}. Please retry with a higher timeout"
+                            f" (current: {self.timeout})."
+                        ) from error
+                    logger.info("Waiting for model to be loaded on the server: %s", error)
+                    await asyncio.sleep(1)
+                    if timeout is not None:
+                        timeout = max(self.timeout - (time.time() - t0), 1)
+                except BaseException:
+                    await client.close()
+                    raise
+
+    async def aclose(self) -> None:
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+
+
+def _dataset_bytes(ds: Any) -> int:
+    """Arrow size of a Dataset or DatasetDict, used as its cache weight.
+
+    Summed from each split's own table: splits share the builder's DatasetInfo,
+    whose `dataset_size` already covers every split (and may be None).
+    """
+    parts = ds.values() if hasattr(ds, "values") else [ds]
+    return max(sum(part.data.nbytes for part in parts), 1)
+
+
+def _first_generated_text(res: list) -> str:
+    if not res:
+        return str(res)
+    first = res[0]
+    if isinstance(first, dict) and "generated_text" in first:
+        return first["generated_text"]
+    return str(first)
+
+
+def _asr_text(res: dict) -> str:
+    return res["text"] if "text" in res else str(res)
+
+
+# Response parsers keyed by the concrete type the client returned; the current
+# client returns plain str, which goes straight through.
+_GENERATION_PARSERS: Dict[type, Callable[[Any], str]] = {str: str, list: _first_generated_text}
+_ASR_PARSERS: Dict[type, Callable[[Any], str]] = {str: str, dict: _asr_text}
+
+
 class HuggingService:
-    """Service that wraps Hugging Face InferenceClient and datasets loader.
+    """Service that wraps Hugging Face AsyncInferenceClient and datasets loader.
 
-    Methods are synchronous (so they can be called via asyncio.to_thread in FastAPI).
+    Inference methods are coroutines awaited directly by the FastAPI endpoints.
+    `load_dataset` stays synchronous because `datasets` is blocking; callers
+    offload it to a worker thread.
     """
 
-    def __init__(self, hf_token: str):
+    def __init__(self, hf_token: str, dataset_cache_bytes: int = 2 << 30):
         if not hf_token:
             raise ValueError("HF_TOKEN is required")
-        self.client = InferenceClient(token=hf_token)
-        self._datasets: Dict[str, Dataset] = {}
+        self.client = PooledAsyncInferenceClient(token=hf_token)
+        # Datasets stay memory-mapped Arrow; the LRU only bounds how many we pin.
+        # Each entry keeps its summary info so cache hits skip re-walking splits.
+        self._datasets: "LRUCache[str, Tuple[Dataset, Dict[str, Any]]]" = LRUCache(
+            maxsize=dataset_cache_bytes, getsizeof=lambda entry: _dataset_bytes(entry[0])
+        )
+        self._datasets_lock = threading.Lock()
+        # (input_type, output_type) -> (scheduler job class, handler) for any_to_any
+        self._routes: Dict[Tuple[str, str], Tuple[str, Callable[[Any, Optional[str]], Awaitable[Any]]]] = {
+            ("audio", "text"): ("audio", self._audio_to_text),
+            ("image", "caption"): ("image", self._image_to_caption),
+            ("image", "vqa"): ("vqa", self._image_to_vqa),
+            ("text", "text"): ("text", self._text_to_text),
+        }
         self.supported = {
             "openai/gsm8k": ["main", "socratic"],
             "mrmrx/CADS-dataset": ["0001_visceral_gc", "0002_visceral_sc", "0003_kits21"],
@@ -24,71 +182,97 @@ class HuggingService:
             "kraina/airbnb": ["all", "weekdays", "weekends"],
         }
 
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
     def _key(self, name: str, subset: Optional[str]) -> str:
         return f"{name}::{subset or ''}"
 
     def load_dataset(self, name: str, subset: Optional[str] = None, streaming: bool = False) -> Dict[str, Any]:
         key = self._key(name, subset)
-        if key in self._datasets:
+        with self._datasets_lock:
+            entry = self._datasets.get(key)
+        if entry is not None:
             logger.info("Dataset cached: %s", key)
-            ds = self._datasets[key]
-        else:
-            logger.info("Loading dataset %s subset=%s streaming=%s", name, subset, streaming)
-            ds = load_dataset(name, subset) if subset else load_dataset(name)
-            self._datasets[key] = ds
+            return dict(entry[1])
 
+        logger.info("Loading dataset %s subset=%s streaming=%s", name, subset, streaming)
+        ds = load_dataset(name, subset, keep_in_memory=False) if subset else load_dataset(name, keep_in_memory=False)
+        info = self._summarize(key, ds)
+        try:
+            with self._datasets_lock:
+                self._datasets[key] = (ds, info)
+        except ValueError:
+            logger.warning("Dataset %s exceeds the cache budget; not caching", key)
+        return dict(info)
+
+    def _summarize(self, key: str, ds: Dataset) -> Dict[str, Any]:
         # Return lightweight info
         info: Dict[str, Any] = {"key": key, "type": type(ds).__name__}
         try:
             if hasattr(ds, "keys"):
                 info["splits"] = list(ds.keys())
-                info["size_per_split"] = {k: len(ds[k]) for k in ds.keys()}
+                # Row counts come straight from Arrow table metadata
+                info["size_per_split"] = dict(ds.num_rows)
             else:
-                info["length"] = len(ds)
+                info["length"] = ds.num_rows
             info["features"] = getattr(ds, "features", None)
         except Exception:
             logger.exception("Failed to summarize dataset %s", key)
         return info
 
-    def generate_text(self, prompt: str, model: str = "gpt2", max_new_tokens: int = 200, **kwargs) -> str:
-        logger.debug("generate_text model=%s tokens=%s", model, max_new_tokens)
-        res = self.client.text_generation(model=model, inputs=prompt, parameters={"max_new_tokens": int(max_new_tokens), **kwargs})
-        if isinstance(res, list) and res:
-            first = res[0]
-            if isinstance(first, dict) and "generated_text" in first:
-                return first["generated_text"]
-            return str(first)
-        return str(res)
+    async def generate_text(self, prompt: str, model: str = "gpt2", max_new_tokens: int = 200, **kwargs) -> str:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("generate_text model=%s tokens=%s", model, max_new_tokens)
+        res = await self.client.text_generation(prompt, model=model, max_new_tokens=max_new_tokens, **kwargs)
+        return _GENERATION_PARSERS.get(type(res), str)(res)
 
-    def transcribe_audio(self, audio_bytes: bytes, model: str = "openai/whisper-large-v2") -> str:
-        logger.debug("transcribe_audio model=%s bytes=%d", model, len(audio_bytes))
-        res = self.client.automatic_speech_recognition(model=model, inputs=audio_bytes)
-        if isinstance(res, dict) and "text" in res:
-            return res["text"]
-        return str(res)
+    async def transcribe_audio(self, audio_bytes: bytes, model: str = "openai/whisper-large-v2") -> str:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("transcribe_audio model=%s bytes=%d", model, len(audio_bytes))
+        res = await self.client.automatic_speech_recognition(audio_bytes, model=model)
+        return _ASR_PARSERS.get(type(res), str)(res)
 
-    def analyze_image(self, image_bytes: bytes, model: str = "Salesforce/blip-image-captioning-large") -> str:
-        logger.debug("analyze_image model=%s bytes=%d", model, len(image_bytes))
-        res = self.client.image_to_text(model=model, inputs=image_bytes)
+    async def analyze_image(self, image_bytes: bytes, model: str = "Salesforce/blip-image-captioning-large") -> str:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("analyze_image model=%s bytes=%d", model, len(image_bytes))
+        res = await self.client.image_to_text(image_bytes, model=model)
         return str(res)
 
-    def multimodal_vqa(self, image_bytes: bytes, question: str, model: str = "dandelin/vilt-b32-finetuned-vqa") -> str:
-        logger.debug("multimodal_vqa model=%s question=%s", model, question)
-        res = self.client.visual_question_answering(model=model, image=image_bytes, question=question)
+    async def multimodal_vqa(self, image_bytes: Union[bytes, memoryview], question: str, model: str = "dandelin/vilt-b32-finetuned-vqa") -> str:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("multimodal_vqa model=%s question=%s", model, question)
+        # VQA base64-encodes the image into a JSON body and only accepts bytes or
+        # file objects, so mmapped uploads are materialized here.
+        if not isinstance(image_bytes, bytes):
+            image_bytes = bytes(image_bytes)
+        res = await self.client.visual_question_answering(image_bytes, question, model=model)
         return str(res)
 
-    def any_to_any(self, *, input_type: str, output_type: str, payload: Any, model: Optional[str] = None) -> Any:
-        logger.debug("any_to_any %s->%s model=%s", input_type, output_type, model)
-        if input_type == "audio" and output_type == "text":
-            return self.transcribe_audio(payload, model=model or "openai/whisper-large-v2")
-        if input_type == "image" and output_type == "caption":
-            return self.analyze_image(payload, model=model or "Salesforce/blip-image-captioning-large")
-        if input_type == "image" and output_type == "vqa":
-            question = payload.get("question") if isinstance(payload, dict) else None
-            if not question:
-                raise ValueError("Missing question for image->vqa")
-            image = payload if isinstance(payload, (bytes, bytearray)) else payload.get("image")
-            return self.multimodal_vqa(image, question, model=model or "dandelin/vilt-b32-finetuned-vqa")
-        if input_type == "text" and output_type == "text":
-            return self.generate_text(payload, model=model or "gpt2")
-        raise ValueError(f"Unsupported conversion {input_type}->{output_type}")
+    async def any_to_any(self, *, input_type: str, output_type: str, payload: Any, model: Optional[str] = None) -> Any:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("any_to_any %s->%s model=%s", input_type, output_type, model)
+        route = self._routes.get((input_type, output_type))
+        if route is None:
+            raise ValueError(f"Unsupported conversion {input_type}->{output_type}")
+        return await route[1](payload, model)
+
+    def any_to_any_job_class(self, input_type: str, output_type: str) -> Optional[str]:
+        """Scheduler job class for a conversion, or None if it is unsupported."""
+        route = self._routes.get((input_type, output_type))
+        return route[0] if route is not None else None
+
+    async def _audio_to_text(self, payload: Any, model: Optional[str]) -> str:
+        return await self.transcribe_audio(payload, model=model or "openai/whisper-large-v2")
+
+    async def _image_to_caption(self, payload: Any, model: Optional[str]) -> str:
+        return await self.analyze_image(payload, model=model or "Salesforce/blip-image-captioning-large")
+
+    async def _image_to_vqa(self, payload: Any, model: Optional[str]) -> str:
+        question = payload.get("question") if isinstance(payload, dict) else None
+        if not question:
+            raise ValueError("Missing question for image->vqa")
+        return await self.multimodal_vqa(payload.get("image"), question, model=model or "dandelin/vilt-b32-finetuned-vqa")
+
+    async def _text_to_text(self, payload: Any, model: Optional[str]) -> str:
+        return await self.generate_text(payload, model=model or "gpt2")